@@ -1,19 +1,74 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 import argparse
+import bisect
 import sys
 import clang.cindex as cindex
 from string import Template
-import unittest
-import re
+import html
 import os
 import shutil
+from array import array
+from collections import defaultdict
+from itertools import accumulate
+from concurrent.futures import ThreadPoolExecutor
+
+
+# The translation table used to escape source code as HTML.
+HTML_ESCAPE_TABLE = str.maketrans({'<': '&lt;', '>': '&gt;', '&': '&amp;'})
+
+# The extensions of the files that are treated as source code.
+SOURCE_EXTENSIONS = frozenset(['h', 'c', 'cc', 'cpp', 'm', 'mm'])
+
+# The CSS class used to highlight each diagnostic severity. Diagnostics with
+# severities that aren't listed here aren't shown.
+DIAGNOSTIC_CLASSES = {
+    cindex.Diagnostic.Warning: 'warning',
+    cindex.Diagnostic.Error: 'error',
+    cindex.Diagnostic.Fatal: 'error',
+}
+
+# The templates that have been loaded so far, keyed by filename. Each entry
+# holds the modification time of the file when it was read, and the template.
+template_cache = {}
+
+
+class FenwickTree:
+    """Maintain prefix sums over a fixed number of integer slots."""
+    def __init__(self, size):
+        """Initialize with size slots, all zero."""
+        # tree[i] holds the sum of the (i & -i) slots ending at slot i-1.
+        self.tree = [0] * (size + 1)
+
+    def __len__(self):
+        return len(self.tree) - 1
+
+    def add(self, i, value):
+        """Add value to slot i."""
+        i += 1
+        n = len(self.tree)
+        while i < n:
+            self.tree[i] += value
+            i += i & -i
+
+    def prefix_sum(self, i):
+        """Return the sum of slots [0, i)."""
+        i = min(i, len(self.tree) - 1)
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
 
 
 class OffsetList:
     """Compute offsets from original positions in text to rewritten ones."""
-    def __init__(self):
-        """Initialize with no changes."""
+    def __init__(self, size=0):
+        """Initialize with no changes.
+
+        size is the number of positions expected to be edited. Positions past
+        it are still accepted, but cause the underlying trees to be rebuilt.
+        """
         # The insertions map from positions to the lengths of the insertion at
         # the given position.
         self.insertions = {}
@@ -22,100 +77,189 @@ class OffsetList:
         # length of the text that was removed.
         self.removals = {}
 
+        # Prefix sums of the two maps above, so that a rewritten position can
+        # be computed without walking every edit.
+        self.insertion_sums = FenwickTree(size)
+        self.removal_sums = FenwickTree(size)
+
     def __repr__(self):
         return str('insertions = {}, removals = {}'.format(self.insertions,
                                                            self.removals))
 
+    def reserve(self, pos):
+        """Make sure that pos can be edited without overflowing the trees."""
+        size = len(self.insertion_sums)
+        if pos < size:
+            return
+
+        size = max(pos + 1, 2 * size)
+        self.insertion_sums = FenwickTree(size)
+        for (key_pos, length) in self.insertions.items():
+            self.insertion_sums.add(key_pos, length)
+        self.removal_sums = FenwickTree(size)
+        for (key_pos, length) in self.removals.items():
+            self.removal_sums.add(key_pos, length)
+
     def insert(self, pos, length):
         """Insert some data at the given position."""
+        self.reserve(pos)
         if pos in self.insertions:
             self.insertions[pos] += length
         else:
             self.insertions[pos] = length
+        self.insertion_sums.add(pos, length)
 
     def get_rewritten_pos(self, pos):
         """Return the rewritten position given an original position."""
-        offset = 0
-        for key_pos in self.insertions:
-            if key_pos > pos:
-                break
-            offset += self.insertions[key_pos]
-
-        for key_pos in self.removals:
-            if key_pos >= pos:
-                break
-            offset -= self.removals[key_pos]
-
+        # Insertions at pos itself come before it, but text removed starting
+        # at pos only affects the positions after it.
+        offset = (self.insertion_sums.prefix_sum(pos + 1) -
+                  self.removal_sums.prefix_sum(pos))
         return max(offset + pos, 0)
 
     def get_insertion_length(self, pos):
         """Return the length of the data inserted at pos."""
-        if pos in self.insertions:
-            return self.insertions[pos]
-        return 0
+        return self.insertions.get(pos, 0)
+
+    def query(self, pos):
+        """Return the rewritten position and the insertion length at pos.
+
+        This is equivalent to calling get_rewritten_pos and
+        get_insertion_length, but only looks up the edits once.
+        """
+        insertion_length = self.insertions.get(pos, 0)
+        offset = (self.insertion_sums.prefix_sum(pos + 1) -
+                  self.removal_sums.prefix_sum(pos))
+        return (max(offset + pos, 0), insertion_length)
 
     def remove(self, pos, length):
         """Remove some data from the given position."""
+        self.reserve(pos)
         if pos in self.removals:
             self.removals[pos] += length
         else:
             self.removals[pos] = length
+        self.removal_sums.add(pos, length)
 
 
-class TestOffsetList(unittest.TestCase):
-    def test_insert(self):
-        ol = OffsetList()
+class PieceTable:
+    """Edit a string without copying it, by keeping a list of its pieces.
 
-        # Inserting before the beginning should offset everything.
-        # ____01234
-        ol.insert(0, 4)
-        for i in range(5):
-            self.assertEqual(ol.get_rewritten_pos(i), i+4)
+    Each piece is a (text, start, end) tuple referring to text[start:end],
+    where text is either the original string or a string that was inserted.
+    """
+    def __init__(self, text):
+        """Initialize with the original text."""
+        self.pieces = [(text, 0, len(text))] if text else []
 
-        # ____01_234
-        ol.insert(2, 1)
-        for i in range(2):
-            self.assertEqual(ol.get_rewritten_pos(i), i+4)
-        for i in range(2, 5):
-            self.assertEqual(ol.get_rewritten_pos(i), i+5)
+        # The position where each piece starts, followed by the total length.
+        # It is rebuilt lazily after the pieces change.
+        self.starts = None
 
-    def test_remove(self):
-        ol = OffsetList()
+    def __str__(self):
+        return ''.join(text[start:end] for (text, start, end) in self.pieces)
 
-        # Remove two characters from the beginning.
-        # 234
-        ol.remove(0, 2)
-        for i in range(2):
-            self.assertEqual(ol.get_rewritten_pos(i), 0)
-        for i in range(2, 5):
-            self.assertEqual(ol.get_rewritten_pos(i), i-2)
+    def __repr__(self):
+        return repr(str(self))
+
+    def split(self, pos):
+        """Split the pieces at pos and return the index of the piece there.
+
+        Positions outside the text are treated as its nearest end, since
+        removing text can leave later edits pointing outside it."""
+        if self.starts is None:
+            lengths = (end - start for (text, start, end) in self.pieces)
+            self.starts = list(accumulate(lengths, initial=0))
+
+        pos = max(0, min(pos, self.starts[-1]))
+        i = bisect.bisect_right(self.starts, pos) - 1
+        piece_start = self.starts[i]
+        if piece_start == pos:
+            return i
+
+        (text, start, end) = self.pieces[i]
+        mid = start + pos - piece_start
+        self.pieces[i:i+1] = [(text, start, mid), (text, mid, end)]
+        self.starts = None
+        return i + 1
+
+    def insert(self, pos, text):
+        """Insert text at the given position."""
+        if text:
+            self.pieces.insert(self.split(pos), (text, 0, len(text)))
+            self.starts = None
+
+    def delete(self, from_pos, to_pos):
+        """Delete the text in [from_pos, to_pos)."""
+        if from_pos < to_pos:
+            i = self.split(from_pos)
+            j = self.split(to_pos)
+            del self.pieces[i:j]
+            self.starts = None
+
+    def replace(self, from_pos, to_pos, text):
+        """Replace the text in [from_pos, to_pos) with the given text."""
+        i = self.split(from_pos)
+        j = self.split(to_pos)
+        self.pieces[i:j] = [(text, 0, len(text))] if text else []
+        self.starts = None
 
 
 class Rewriter:
     """Rewrite buffers of text, using line/column coordinates.
     """
 
+    # The kinds of edits that can be passed to commit.
+    INSERT_BEFORE = 0
+    INSERT_AFTER = 1
+    REMOVE = 2
+
     def __init__(self, buf):
         """Initialize with the initial buffer."""
-        self.lines = buf.splitlines()
-        self.col_offs = [OffsetList() for i in range(len(self.lines))]
-        self.col_lens = [len(line) for line in self.lines]
+        lines = buf.splitlines()
+        self.original_lines = lines
+        self.line_pieces = [PieceTable(line) for line in lines]
+
+        # The text of each rewritten line, or None if it has been edited since
+        # it was last joined from its pieces.
+        self.line_cache = list(lines)
+        self.col_lens = array('i', [len(line) for line in lines])
+
+        # Offset lists are only allocated for lines that are actually edited.
+        self.col_offs = [None] * len(lines)
+
+        # Edits made by commit aren't recorded in the offset lists, so once it
+        # has been called, no more edits can be made.
+        self.committed = False
 
     def __repr__(self):
         return str(self.col_offs)
 
+    def get_col_off(self, line):
+        """Return the offset list for the given line, creating it if needed."""
+        col_off = self.col_offs[line]
+        if col_off is None:
+            # Columns may refer to the position just past the end of the line.
+            col_off = OffsetList(self.col_lens[line] + 1)
+            self.col_offs[line] = col_off
+        return col_off
+
     def insert_before(self, text, line, col):
         """Insert text at the given line/column.
 
         If text has already been inserted there, the new text will go at the
         beginning of the existing text.
         """
-        col = self.canonicalize_column_index(line, col)
-        col_off = self.col_offs[line]
-        adj_col = (col_off.get_rewritten_pos(col) -
-                   col_off.get_insertion_length(col))
-        theline = self.lines[line]
-        self.lines[line] = theline[:adj_col] + text + theline[adj_col:]
+        assert not self.committed
+        # Negative columns count back from the end of the line.
+        if col < 0:
+            col += self.col_lens[line] + 1
+        assert col >= 0
+        col_off = self.get_col_off(line)
+        (adj_col, insertion_length) = col_off.query(col)
+        adj_col -= insertion_length
+        self.line_pieces[line].insert(adj_col, text)
+        self.line_cache[line] = None
         col_off.insert(col, len(text))
 
     def insert_after(self, text, line, col):
@@ -124,41 +268,144 @@ class Rewriter:
         If text has already been inserted there, the new text will go at the
         end of the existing text.
         """
-        col = self.canonicalize_column_index(line, col)
-        col_off = self.col_offs[line]
+        assert not self.committed
+        if col < 0:
+            col += self.col_lens[line] + 1
+        assert col >= 0
+        col_off = self.get_col_off(line)
         adj_col = col_off.get_rewritten_pos(col)
-        theline = self.lines[line]
-        self.lines[line] = theline[:adj_col] + text + theline[adj_col:]
+        self.line_pieces[line].insert(adj_col, text)
+        self.line_cache[line] = None
         col_off.insert(col, len(text))
 
     def remove(self, from_line, from_col, to_line, to_col):
         """Remove the given range of text."""
+        assert not self.committed
         assert from_line == to_line
-        from_col = self.canonicalize_column_index(from_line, from_col)
-        to_col = self.canonicalize_column_index(to_line, to_col)
-
-        col_off = self.col_offs[from_line]
+        col_len = self.col_lens[from_line]
+        if from_col < 0:
+            from_col += col_len + 1
+        if to_col < 0:
+            to_col += col_len + 1
+        assert 0 <= from_col <= to_col
+
+        col_off = self.get_col_off(from_line)
         adj_from_col = col_off.get_rewritten_pos(from_col)
         adj_to_col = col_off.get_rewritten_pos(to_col)
-        theline = self.lines[from_line]
-        self.lines[from_line] = theline[:adj_from_col] + theline[adj_to_col:]
+        self.line_pieces[from_line].delete(adj_from_col, adj_to_col)
+        self.line_cache[from_line] = None
         col_off.remove(from_col, to_col-from_col)
 
     def replace(self, text, from_line, from_col, to_line, to_col):
-        """Replace the given range of text."""
-        self.remove(from_line, from_col, to_line, to_col)
-        self.insert_after(text, from_line, from_col)
+        """Replace the given range of text.
 
-    def canonicalize_column_index(self, line, col):
-        """If the column index is negative, wrap it around to be positive."""
-        if col < 0:
-            col += self.col_lens[line] + 1
-        assert col >= 0
-        return col
+        This is the same as removing the range and then inserting the text
+        after anything already inserted at its start."""
+        assert not self.committed
+        assert from_line == to_line
+        col_len = self.col_lens[from_line]
+        if from_col < 0:
+            from_col += col_len + 1
+        if to_col < 0:
+            to_col += col_len + 1
+        assert 0 <= from_col <= to_col
+
+        # Removing text from from_col onwards doesn't move from_col itself, so
+        # the inserted text goes where the removed text started.
+        col_off = self.get_col_off(from_line)
+        adj_from_col = col_off.get_rewritten_pos(from_col)
+        adj_to_col = col_off.get_rewritten_pos(to_col)
+        self.line_pieces[from_line].replace(adj_from_col, adj_to_col, text)
+        self.line_cache[from_line] = None
+        col_off.remove(from_col, to_col-from_col)
+        col_off.insert(from_col, len(text))
+
+    def commit(self, edits, escape=None):
+        """Apply a batch of edits, rebuilding each edited line only once.
+
+        Each edit is a tuple of (line, col, kind, arg), where kind is one of
+        INSERT_BEFORE, INSERT_AFTER, or REMOVE. For insertions, arg is the text
+        to insert, and for removals it is the column where the removal ends.
+        All columns refer to the original text. Insertions at the same column
+        are ordered as if they had been made one at a time through
+        insert_before and insert_after. Removals only remove original text, so
+        text inserted inside a removed range or at either edge of it is kept,
+        whatever order the edits are in. (remove also removes text already
+        inserted at the end of its range.) The edited lines must not have been
+        edited by those methods already, and no edits can be made after the
+        batch, including another batch.
+
+        If escape is given, it is a function that is applied to all of the
+        original text that is kept, but not to any inserted text. Every line
+        is then rebuilt from the original text, so no line may have been
+        edited by those methods already.
+        """
+        assert not self.committed
+        self.committed = True
+
+        line_insertions = {}
+        line_removals = {}
+        for (i, (line, col, kind, arg)) in enumerate(edits):
+            if col < 0:
+                col += self.col_lens[line] + 1
+            assert col >= 0
+            if kind == Rewriter.REMOVE:
+                to_col = arg
+                if to_col < 0:
+                    to_col += self.col_lens[line] + 1
+                assert to_col >= col
+                line_removals.setdefault(line, []).append((col, to_col))
+                line_insertions.setdefault(line, [])
+                continue
+
+            # Text inserted before goes ahead of everything inserted at the
+            # same column so far, so later insertions sort first.
+            if kind == Rewriter.INSERT_BEFORE:
+                key = (col, 0, -i)
+            else:
+                key = (col, 1, i)
+            line_insertions.setdefault(line, []).append((key, arg))
+
+        if escape is None:
+            escape = str
+        else:
+            for (line, text) in enumerate(self.original_lines):
+                assert self.col_offs[line] is None
+                if line not in line_insertions:
+                    escaped = escape(text)
+                    self.line_pieces[line] = PieceTable(escaped)
+                    self.line_cache[line] = escaped
+
+        for (line, insertions) in line_insertions.items():
+            assert self.col_offs[line] is None
+            insertions.sort()
+            removals = sorted(line_removals.get(line, []))
+            removals.reverse()
+            text = self.original_lines[line]
+
+            # Walk the original text once, copying what wasn't removed and
+            # emitting each insertion when we reach its column.
+            out = []
+            pos = 0
+            end = ((len(text), 0, 0), '')
+            for ((col, _, _), inserted) in insertions + [end]:
+                while removals and removals[-1][0] < col:
+                    (from_col, to_col) = removals.pop()
+                    if pos < from_col:
+                        out.append(escape(text[pos:from_col]))
+                    pos = max(pos, to_col)
+                if pos < col:
+                    out.append(escape(text[pos:col]))
+                    pos = col
+                out.append(inserted)
+
+            rewritten = ''.join(out)
+            self.line_pieces[line] = PieceTable(rewritten)
+            self.line_cache[line] = rewritten
 
     def is_in_range(self, line, col):
         """Return whether the given line/column index is in range."""
-        if line >= len(self.lines):
+        if line >= len(self.col_lens):
             return False
         if col > self.col_lens[line]:
             return False
@@ -167,94 +414,39 @@ class Rewriter:
     @property
     def lines(self):
         """Return the rewritten lines."""
-        return self.lines
-
-
-class TestRewriter(unittest.TestCase):
-    def test_single_line(self):
-        rw = Rewriter("test")
-        rw.insert_before("_", line=0, col=2)
-        self.assertEqual(rw.lines[0], "te_st")
-
-        # Now inserting after where we already did should be properly offset.
-        rw.insert_before("$$", line=0, col=3)
-        self.assertEqual(rw.lines[0], "te_s$$t")
-
-        # Now try inserting before either point.
-        rw.insert_before("%%%", line=0, col=1)
-        self.assertEqual(rw.lines[0], "t%%%e_s$$t")
-
-        # Now try the very end.
-        rw.insert_before("!", line=0, col=4)
-        self.assertEqual(rw.lines[0], "t%%%e_s$$t!")
-
-    def test_before_after(self):
-        rw = Rewriter("0123")
-        rw.insert_before("b", line=0, col=2)
-        self.assertEqual(rw.lines[0], "01b23")
-
-        rw.insert_before("a", line=0, col=2)
-        self.assertEqual(rw.lines[0], "01ab23")
-
-        rw.insert_after("c", line=0, col=2)
-        self.assertEqual(rw.lines[0], "01abc23")
-
-    def test_negative_col(self):
-        rw = Rewriter("0123")
-        rw.insert_before("4", line=0, col=-1)
-        self.assertEqual(rw.lines[0], "01234")
-
-    def test_remove(self):
-        rw = Rewriter("012345")
-        rw.remove(from_line=0, from_col=2, to_line=0, to_col=4)
-        self.assertEqual(rw.lines[0], "0145")
-
-    def test_replace(self):
-        rw = Rewriter("01xx45")
-        rw.replace("23", from_line=0, from_col=2, to_line=0, to_col=4)
-        self.assertEqual(rw.lines[0], "012345")
-
-    def test_two_replacements(self):
-        rw = Rewriter("#include <iostream>")
-        rw.replace("&lt;", 0, 9, 0, 10)
-        self.assertEqual(rw.lines[0], "#include &lt;iostream>")
-        rw.replace("&gt;", 0, 18, 0, 19)
-        self.assertEqual(rw.lines[0], "#include &lt;iostream&gt;")
-
-    def test_two_consecutive_replacements(self):
-        rw = Rewriter('  std::cout << "Hello, world!";')
-        rw.replace("&lt;", 0, 12, 0, 13)
-        self.assertEqual(rw.lines[0], '  std::cout &lt;< "Hello, world!";')
-        rw.replace("&lt;", 0, 13, 0, 14)
-        self.assertEqual(rw.lines[0], '  std::cout &lt;&lt; "Hello, world!";')
+        for (line, text) in enumerate(self.line_cache):
+            if text is None:
+                self.line_cache[line] = str(self.line_pieces[line])
+        return list(self.line_cache)
 
 
 def find_cursor_kind(node, kind):
     """Return a list of all nodes with the given cursor kind."""
-    def visitor(node, parent, found):
-        if node.kind == kind:
-            found.append(node)
-        return 2
-
-    found = []
-    cindex.Cursor_visit(node,
-                        cindex.Cursor_visit_callback(visitor),
-                        found)
-
-    return found
+    return [n for n in node.walk_preorder() if n.kind == kind]
 
 
 def find_cursor_kinds(node, kinds):
     """Return a list of all nodes with one of the given kinds."""
-    def visitor(node, parent, found):
-        if node.kind in kinds:
-            found.append(node)
-        return 2
+    kinds = frozenset(kinds)
+    return [n for n in node.walk_preorder() if n.kind in kinds]
+
 
+def find_cursor_kind_in_file(node, kind, filename):
+    """Return a list of all nodes with the given kind in the given file.
+
+    Subtrees that belong to other files, such as included headers, are not
+    visited at all."""
     found = []
-    cindex.Cursor_visit(node,
-                        cindex.Cursor_visit_callback(visitor),
-                        found)
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        node_file = node.location.file
+        if node_file is not None:
+            if node_file.name != filename:
+                continue
+            if node.kind == kind:
+                found.append(node)
+        stack.extend(node.get_children())
 
     return found
 
@@ -269,30 +461,24 @@ def get_line_diagnostics(tus):
     any location are filtered out. Diagnostics with identical messages at the
     same line of source code will be filtered out so that only one appears.
     """
-    diags = {}
-    for (file, tu) in tus.iteritems():
+    diags = defaultdict(lambda: defaultdict(set))
+    for tu in tus.values():
         for diag in tu.diagnostics:
-            if diag.location.file is None:
+            diag_class = DIAGNOSTIC_CLASSES.get(diag.severity)
+            if diag_class is None:
                 continue
-            if diag.severity < cindex.Diagnostic.Warning:
-                continue
-
-            if diag.severity >= cindex.Diagnostic.Error:
-                diag_class = 'error'
-            else:
-                diag_class = 'warning'
 
-            filename = diag.location.file.name
-            line = diag.location.line
-            diag_tup = (diag_class, diag.spelling)
+            # Each of these properties calls into libclang, so only ask once.
+            location = diag.location
+            file = location.file
+            if file is None:
+                continue
 
-            if filename not in diags:
-                diags[filename] = {}
-            if line not in diags[filename]:
-                diags[filename][line] = set()
-            diags[filename][line].add(diag_tup)
+            diags[file.name][location.line].add((diag_class, diag.spelling))
 
-    return diags
+    # Looking up a file or line without diagnostics should raise KeyError
+    # rather than add it.
+    return {filename: dict(lines) for (filename, lines) in diags.items()}
 
 
 class LineAndColumn:
@@ -322,94 +508,145 @@ class HTMLAnnotationSet:
 
         The 'tag' argument is the type of HTML tag to add. Attributes is a list
         of pairs, where the first element is the attribute name, and the second
-        is the attribute value."""
-        self.tags.append((tag, attributes, extent))
-
-    def apply(self, rewriter):
-        """Apply our set of tags to the rewriter."""
-        for (tag, attributes, extent) in self.tags:
-            start = extent.start
-            start_line = start.line - 1
-            start_col = start.column - 1
+        is the attribute value. Attribute values are escaped here, so they
+        should be given as plain text.
+
+        The extent is only read here, so it may refer to a translation unit
+        that is freed before the tags are applied."""
+        start_tag = '<' + tag
+        # If the tag has to be split, the later pieces are opened with this
+        # instead, since an id must only appear once in the document.
+        continue_tag = start_tag
+        for (name, value) in attributes:
+            attribute = ' ' + name + '="' + html.escape(value) + '"'
+            start_tag += attribute
+            if name != 'id':
+                continue_tag += attribute
+        start_tag += '>'
+        continue_tag += '>'
+        start = extent.start
+        end = extent.end
+        self.tags.append((start_tag, continue_tag, '</' + tag + '>',
+                          start.line, start.column, end.line, end.column))
+
+    def apply(self, rewriter, edits):
+        """Append the edits that apply our set of tags to the rewriter.
+
+        The tags are nested so that the HTML is well formed. Tags that start at
+        the same place are opened outermost first, and a tag that runs past
+        the end of an enclosing tag is split in two at that point."""
+        # Each span is (start_line, start_col, -end_line, -end_col, order,
+        # start_tag, continue_tag, end_tag), so that sorting them puts outer
+        # spans first.
+        spans = []
+        for (order, tag) in enumerate(self.tags):
+            (start_tag, continue_tag, end_tag, start_line, start_col, end_line,
+             end_col) = tag
+            start_line -= 1
+            start_col -= 1
             if not rewriter.is_in_range(start_line, start_col):
                 continue
+            if start_col < 0:
+                start_col += rewriter.col_lens[start_line] + 1
 
-            end = extent.end
-            end_line = end.line - 1
-            end_col = end.column - 1
+            end_line -= 1
+            end_col -= 1
             if not rewriter.is_in_range(end_line, end_col):
                 continue
+            if end_col < 0:
+                end_col += rewriter.col_lens[end_line] + 1
 
-            start_tag = '<' + tag
-            if attributes:
-                attr = ' '.join([a[0] + '="' + a[1] + '"' for a in attributes])
-                start_tag += ' ' + attr
-            start_tag += '>'
+            if (end_line, end_col) < (start_line, start_col):
+                continue
+
+            spans.append((start_line, start_col, -end_line, -end_col, order,
+                          start_tag, continue_tag, end_tag))
+        spans.sort()
+
+        # All of the edits are appended in document order, so they can all be
+        # inserted after whatever came before them at the same column.
+        def close(end, end_tag):
+            edits.append((end[0], end[1], Rewriter.INSERT_AFTER, end_tag))
+
+        # The stack of (end, end_tag) for the open spans. Each span ends no
+        # later than the one enclosing it.
+        open_spans = []
+        i = 0
+        while i < len(spans):
+            (start_line, start_col, neg_end_line, neg_end_col, order,
+             start_tag, continue_tag, end_tag) = spans[i]
+            i += 1
+            start = (start_line, start_col)
+            end = (-neg_end_line, -neg_end_col)
 
-            end_tag = '</' + tag + '>'
+            while open_spans and open_spans[-1][0] <= start:
+                close(*open_spans.pop())
 
-            rewriter.insert_before(start_tag, start_line, start_col)
-            rewriter.insert_after(end_tag, end_line, end_col)
+            if open_spans and open_spans[-1][0] < end:
+                # Stop this span where the enclosing one ends, and pick the
+                # rest of it up again from there.
+                split = open_spans[-1][0]
+                bisect.insort(spans, (split[0], split[1], neg_end_line,
+                                      neg_end_col, order, continue_tag,
+                                      continue_tag, end_tag),
+                              lo=i)
+                end = split
 
+            edits.append((start_line, start_col, Rewriter.INSERT_AFTER,
+                          start_tag))
+            open_spans.append((end, end_tag))
 
-def sanitize_code_as_html(rewriter):
-    """Rewrite all whitespace, <>, etc, so that it's valid HTML."""
-    # Generate a list of whitespace, <>, etc, to rewrite, and do it all at
-    # once. This is because we're searching by position in the rewriter's
-    # buffer, which will get changed once we rewrite it.
-    replacements = []
-    for (line, text) in enumerate(rewriter.lines):
-        for col in [m.start() for m in re.finditer('<', text)]:
-            replacements.append(("&lt;", line, col, line, col+1))
-        for col in [m.start() for m in re.finditer('>', text)]:
-            replacements.append(("&gt;", line, col, line, col+1))
+        while open_spans:
+            close(*open_spans.pop())
 
-    for (text, from_line, from_col, to_line, to_col) in replacements:
-        rewriter.replace(text, from_line, from_col, to_line, to_col)
+
+def sanitize_code_as_html(text):
+    """Escape all <, >, and & in the text, so that it's valid HTML."""
+    return text.translate(HTML_ESCAPE_TABLE)
 
 
 def highlight_diagnostics(diagnostics, annotation_set):
     """Highlight all diagnostics in the translation unit."""
-    for (line, diags) in diagnostics.iteritems():
-        most_severe_class = None
-        for (diag_class, msg) in diags:
-            if most_severe_class is None:
-                most_severe_class = diag_class
-            elif diag_class == 'error':
+    for (line, diags) in diagnostics.items():
+        most_severe_class = 'warning'
+        messages = []
+        for (diag_class, msg) in sorted(diags):
+            if diag_class == 'error':
                 most_severe_class = diag_class
-                break
+            messages.append(diag_class + ': ' + html.escape(msg))
 
-        messages = '<br />'.join([diag[0] + ': ' + diag[1] for diag in diags])
         annotation_set.add_tag('span',
                                [
-                                   ('class', diag_class),
-                                   ('title', messages),
+                                   ('class', most_severe_class),
+                                   ('title', '<br />'.join(messages)),
                                ],
                                EntireLineSourceLocation(line))
 
 
 def find_all_usrs(tus, input_files):
     """Build a map of all nodes in the input files."""
+    nodes = {}
+    for tu in tus.values():
+        add_usrs(nodes, tu)
+    return nodes
 
-    def visit_children(node, visited_nodes):
-        if node.get_usr() in visited_nodes:
-            return
-        assert node != cindex.conf.lib.clang_getNullCursor()
 
-        if (node.kind.is_declaration() and
-                node.get_definition()):
-            # Hack. The API doesn't seem to expose a way to query *if*
-            # a node is the definition.
-            if node.get_definition() == node:
-                visited_nodes[node.get_usr()] = node
+def add_usrs(nodes, tu):
+    """Add the definitions in the translation unit to a map of USRs to nodes.
 
-    nodes = {}
-    for (src, tu) in tus.iteritems():
-        cursor = tu.cursor
-        for node in cursor.get_children():
-            visit_children(node, nodes)
+    USRs that are already in the map keep the definition found first."""
+    for node in tu.cursor.walk_preorder():
+        if not node.kind.is_declaration():
+            continue
+        usr = node.get_usr()
+        if usr in nodes:
+            continue
 
-    return nodes
+        # Hack. The API doesn't seem to expose a way to query *if* a node is
+        # the definition.
+        defn = node.get_definition()
+        if defn is not None and defn == node:
+            nodes[usr] = node
 
 
 def find_reference_definition(reference, all_nodes):
@@ -441,37 +678,45 @@ def link_function_calls(tu, all_nodes, annotation_set, src_to_output,
     src_to_output should map from absolute source file paths to output file
     paths suitable for linking to. anchored_nodes will be updated by adding any
     function definitions that are referenced."""
-    fn_calls = find_cursor_kind(tu.cursor, cindex.CursorKind.CALL_EXPR)
-    fn_calls = [fn for fn in fn_calls if fn.location.file.name == tu.spelling]
+    fn_calls = find_cursor_kind_in_file(tu.cursor, cindex.CursorKind.CALL_EXPR,
+                                        tu.spelling)
+
+    # Many calls usually go to the same few definitions, so only look up
+    # where each definition lives once. It maps from the definition's hash to
+    # its href, or None if it isn't in any output file.
+    hrefs = {}
 
     for call in fn_calls:
         defn = find_reference_definition(call, all_nodes)
         if defn is None:
             continue
 
-        file = defn.location.file.name
-        if file not in src_to_output:
+        defn_hash = defn.hash
+        if defn_hash in hrefs:
+            target_href = hrefs[defn_hash]
+        else:
+            target_href = None
+            file = defn.location.file.name
+            if file in src_to_output:
+                target_href = src_to_output[file] + '#' + str(defn_hash)
+                anchored_nodes[defn_hash] = defn
+            hrefs[defn_hash] = target_href
+
+        if target_href is None:
             continue
 
         extent = cindex.Cursor_spellingNameRange(call, 0, 0)
-
-        target_file = src_to_output[file]
-        target_hash = str(defn.hash)
-        target_href = target_file + '#' + target_hash
-
         annotation_set.add_tag('a',
                                [('href', target_href)],
                                extent)
 
-        anchored_nodes[defn.hash] = defn
-
 
 def add_anchors(annotation_sets, anchored_nodes):
     """Add an anchor for every node in anchored_nodes.
 
     This allows us to link to AST nodes.
     """
-    for (hash, node) in anchored_nodes.iteritems():
+    for (hash, node) in anchored_nodes.items():
         filename = node.location.file.name
         if filename not in annotation_sets:
             continue
@@ -482,10 +727,75 @@ def add_anchors(annotation_sets, anchored_nodes):
                                node.extent)
 
 
-def format_source(src_filename, src, annotation_set, tpl,
+class CompiledTemplate:
+    """A string.Template that is split at its placeholders ahead of time, so
+    that substituting doesn't need to search the template again."""
+
+    def __init__(self, template):
+        """Initialize with the text of the template."""
+        # A list of (literal, name) pairs, giving the text before each
+        # placeholder and the placeholder's name, and the text after the last
+        # placeholder.
+        self.segments = []
+        literal = []
+        pos = 0
+        for match in Template.pattern.finditer(template):
+            literal.append(template[pos:match.start()])
+            pos = match.end()
+            if match.group('escaped') is not None:
+                literal.append(Template.delimiter)
+                continue
+
+            name = match.group('named') or match.group('braced')
+            if name is None:
+                raise ValueError('Invalid placeholder at position {}'.format(
+                    match.start()))
+            self.segments.append((''.join(literal), name))
+            literal = []
+        literal.append(template[pos:])
+        self.tail = ''.join(literal)
+
+    def substitute(self, **values):
+        """Return the template with each placeholder replaced by its value."""
+        out = []
+        for (literal, name) in self.segments:
+            out.append(literal)
+            out.append(str(values[name]))
+        out.append(self.tail)
+        return ''.join(out)
+
+    def write(self, file, **values):
+        """Write the template to the file with each placeholder replaced by
+        its value.
+
+        This is the same as writing the result of substitute, but the whole
+        page is never built up as one string."""
+        for (literal, name) in self.segments:
+            file.write(literal)
+            file.write(str(values[name]))
+        file.write(self.tail)
+
+
+def load_template(tpl_filename):
+    """Return the template in the given file.
+
+    The file is only read again if it has been modified since it was last
+    loaded."""
+    mtime = os.stat(tpl_filename).st_mtime_ns
+    cached = template_cache.get(tpl_filename)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(tpl_filename, 'r') as tpl_file:
+        tpl = CompiledTemplate(tpl_file.read())
+    template_cache[tpl_filename] = (mtime, tpl)
+    return tpl
+
+
+def format_source(out, src_filename, src, annotation_set, tpl,
                   web_path, index_path):
     """Format source code as HTML using the given template.
 
+    out: The file to write the formatted page to.
     src_filename: The name of this source file, as it should be displayed. For
         display purposes only.
     src: The source code.
@@ -494,15 +804,22 @@ def format_source(src_filename, src, annotation_set, tpl,
     web_path: The relative path to the web assets.
     index_path: The relative path to the source index page.
     """
-    rw = Rewriter(src)
-    sanitize_code_as_html(rw)
-    annotation_set.apply(rw)
-    code = '\n'.join(rw.lines)
+    if annotation_set.tags:
+        rw = Rewriter(src)
+        edits = []
+        annotation_set.apply(rw, edits)
+        rw.commit(edits, escape=sanitize_code_as_html)
+        code = '\n'.join(rw.lines)
+    else:
+        # With nothing to annotate, escaping is all that's left to do, and it
+        # can be done to the whole file at once.
+        code = sanitize_code_as_html('\n'.join(src.splitlines()))
 
-    return tpl.substitute(filename=src_filename,
-                          web_path=web_path,
-                          code=code,
-                          index_path=index_path)
+    tpl.write(out,
+              filename=src_filename,
+              web_path=web_path,
+              code=code,
+              index_path=index_path)
 
 
 def split_args(args):
@@ -511,58 +828,70 @@ def split_args(args):
     The sets of arguments are separated by '--'. We use our_args, and pass
     along clang_args to clang.
     """
-    double_dash_pos = [i for i, x in enumerate(args) if x == '--']
-    if not double_dash_pos:
+    try:
+        double_dash_pos = args.index('--')
+    except ValueError:
         return (args, [])
-    else:
-        double_dash_pos = double_dash_pos[0]
-        return (args[:double_dash_pos], args[double_dash_pos+1:])
-
-
-class TestSplitArgs(unittest.TestCase):
-    def test_no_args(self):
-        self.assertEqual(split_args([]), ([], []))
-
-    def test_both_args(self):
-        our_args = ['--a', 'foo']
-        clang_args = ['-Wall', '-Wextra', '--', 'bar']
-        self.assertEqual(split_args(our_args + ['--'] + clang_args),
-                         (our_args, clang_args))
-
-    def test_no_clang_args(self):
-        our_args = ['--a', 'foo']
-        self.assertEqual(split_args(our_args), (our_args, []))
-        self.assertEqual(split_args(our_args + ['--']), (our_args, []))
+    return (args[:double_dash_pos], args[double_dash_pos+1:])
 
 
 def get_source_file_list(dir):
     """Recursively find all source files in the given directory.
 
-    Filenames are all given as absolute paths."""
-    extensions = ['h', 'c', 'cc', 'cpp', 'm', 'mm']
-    extensions = tuple(['.' + x for x in extensions])
-
-    files = set()
-    for (dirpath, dirnames, filenames) in os.walk(dir):
-        files.update([os.path.join(dirpath, name) for name in filenames if
-                      name.endswith(extensions)])
-
-    return [os.path.abspath(file) for file in files]
+    Filenames are all given as absolute paths, in sorted order so that every
+    run sees the files in the same order."""
+    src_files = []
+    # Paths built by scandir are absolute as long as the root is.
+    dirs = [os.path.abspath(dir)]
+    while dirs:
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                    continue
+                (_, dot, ext) = entry.name.rpartition('.')
+                # Only symlinks need a stat to tell whether they're files.
+                if dot and ext in SOURCE_EXTENSIONS and entry.is_file():
+                    src_files.append(entry.path)
+
+    src_files.sort()
+    return src_files
 
 
 def copy_web_resources(output_dir):
-    """Copy all the resources in our 'web' directory to the output path."""
+    """Copy all the resources in our 'web' directory to the output path.
+
+    Files that were already copied by an earlier run, and haven't changed
+    since, are left alone."""
     mypath = os.path.dirname(os.path.realpath(__file__))
     web_path = os.path.join(mypath, 'web')
 
-    for (dirpath, dirnames, filenames) in os.walk(web_path):
-        relpath = os.path.relpath(dirpath, web_path)
-        tgtpath = os.path.join(output_dir, relpath)
-        if not os.path.exists(tgtpath):
-            os.makedirs(tgtpath)
+    def is_up_to_date(entry, tgt_entry):
+        if tgt_entry is None:
+            return False
+        src_stat = entry.stat()
+        tgt_stat = tgt_entry.stat()
+        return (tgt_stat.st_size == src_stat.st_size and
+                tgt_stat.st_mtime_ns == src_stat.st_mtime_ns)
+
+    def copy_dir(src_dir, tgt_dir):
+        os.makedirs(tgt_dir, exist_ok=True)
 
-        for f in [os.path.join(dirpath, filename) for filename in filenames]:
-            shutil.copy(f, tgtpath)
+        # List what was copied before once, instead of probing every file.
+        with os.scandir(tgt_dir) as entries:
+            tgt_entries = {entry.name: entry for entry in entries}
+
+        with os.scandir(src_dir) as entries:
+            for entry in entries:
+                tgt = os.path.join(tgt_dir, entry.name)
+                if entry.is_dir():
+                    copy_dir(entry.path, tgt)
+                elif not is_up_to_date(entry, tgt_entries.get(entry.name)):
+                    # copy2 keeps the modification time, which is what lets
+                    # the next run tell that the copy is up to date.
+                    shutil.copy2(entry.path, tgt)
+
+    copy_dir(web_path, output_dir)
 
 
 def is_header(filename):
@@ -575,14 +904,13 @@ def is_header(filename):
 def generate_source_index(src_to_output, input_dir, output_dir, output_src_dir,
                           web_path, tpl_filename):
     """Create a listing of all source files in output_dir."""
-    with open(tpl_filename, 'r') as tpl_file:
-        tpl = Template(tpl_file.read())
+    tpl = load_template(tpl_filename)
 
     source_list = (
         ['<li><a href="{}">{}</a></li>\n'.format(
             os.path.relpath(output, output_dir),
             os.path.relpath(src, input_dir))
-         for (src, output) in sorted(src_to_output.iteritems())])
+         for (src, output) in sorted(src_to_output.items())])
 
     return tpl.substitute(source_list='\n'.join(source_list),
                           web_path=web_path)
@@ -590,8 +918,7 @@ def generate_source_index(src_to_output, input_dir, output_dir, output_src_dir,
 
 def generate_outputs(input_dir, output_dir, clang_args):
     """Read the source files and generate the formatted output."""
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
 
     output_src_dir = os.path.join(output_dir, 'src/')
     web_dir = os.path.join(output_dir, 'web/')
@@ -600,13 +927,30 @@ def generate_outputs(input_dir, output_dir, clang_args):
     input_files = get_source_file_list(input_dir)
 
     index = cindex.Index.create()
-    tus = {}
-    for src_filename in input_files:
+    src_texts = {}
+
+    def load(src_filename):
+        with open(src_filename, 'r') as src_file:
+            src = src_file.read()
+        src_texts[src_filename] = src
+
+        if is_header(src_filename):
+            return None
+
         rel_src = os.path.relpath(src_filename, input_dir)
         print('Parsing ' + rel_src)
-
-        if not is_header(src_filename):
-            tus[src_filename] = index.parse(src_filename, args=clang_args)
+        # Hand clang the contents we already read, so that it doesn't read
+        # the file again and so that it sees exactly what we'll format.
+        return index.parse(src_filename, args=clang_args,
+                           unsaved_files=[(src_filename, src)])
+
+    # libclang releases the GIL while parsing, so translation units can be
+    # parsed in parallel from threads sharing one index.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        tus = {src: tu
+               for (src, tu) in zip(input_files,
+                                    executor.map(load, input_files))
+               if tu is not None}
 
     print('Performing cross-translation-unit analysis...')
     all_nodes = find_all_usrs(tus, input_files)
@@ -619,6 +963,7 @@ def generate_outputs(input_dir, output_dir, clang_args):
                           os.path.relpath(src, input_dir)+'.html')
         for src in input_files
     }
+    rel_src_to_output_by_dir = {}
     for src_filename in input_files:
         rel_src = os.path.relpath(src_filename, input_dir)
         print('Analyzing ' + rel_src)
@@ -632,13 +977,17 @@ def generate_outputs(input_dir, output_dir, clang_args):
         if src_filename not in tus:
             continue
 
-        tu = tus[src_filename]
         output_filename = src_to_output[src_filename]
         output_path = os.path.dirname(output_filename)
-        rel_src_to_output = {src: os.path.relpath(src_to_output[src],
-                                                  output_path)
-                             for src in src_to_output}
-        link_function_calls(tu,
+
+        # The relative links only depend on the output directory, which is
+        # shared by every source in the same input directory.
+        rel_src_to_output = rel_src_to_output_by_dir.get(output_path)
+        if rel_src_to_output is None:
+            rel_src_to_output = {src: os.path.relpath(output, output_path)
+                                 for (src, output) in src_to_output.items()}
+            rel_src_to_output_by_dir[output_path] = rel_src_to_output
+        link_function_calls(tus[src_filename],
                             all_nodes,
                             annotation_set,
                             rel_src_to_output,
@@ -646,33 +995,50 @@ def generate_outputs(input_dir, output_dir, clang_args):
 
     add_anchors(annotation_sets, anchored_nodes)
 
-    with open('templates/source.html', 'r') as tpl_file:
-        tpl = Template(tpl_file.read())
+    # The annotation sets hold plain lines and columns, so nothing needs the
+    # translation units any more. Free them before formatting the output.
+    del tus, all_nodes, anchored_nodes
+
+    # Load the template before the output threads start, so they never race
+    # to fill the cache.
+    tpl = load_template('templates/source.html')
 
     index_filename = os.path.join(output_dir, 'index.html')
 
-    for src_filename in input_files:
+    # The output directories that have been created, mapped to the relative
+    # paths to the web assets and the index from inside them.
+    output_dirs = {}
+
+    def emit(src_filename):
         rel_src = os.path.relpath(src_filename, input_dir)
         print('Outputting ' + rel_src)
 
-        with open(src_filename, 'r') as src_file:
-            src = src_file.read()
+        # This is the last use of the source, so let it be freed afterwards.
+        src = src_texts.pop(src_filename)
 
         output_filename = src_to_output[src_filename]
         output_path = os.path.dirname(output_filename)
-        if not os.path.exists(output_path):
-            os.makedirs(output_path)
-
-        web_path = os.path.relpath(web_dir, output_path)
-        index_path = os.path.relpath(index_filename, output_path)
+        paths = output_dirs.get(output_path)
+        if paths is None:
+            # Several files may be creating the same directory at once.
+            os.makedirs(output_path, exist_ok=True)
+            paths = (os.path.relpath(web_dir, output_path),
+                     os.path.relpath(index_filename, output_path))
+            output_dirs[output_path] = paths
+        (web_path, index_path) = paths
 
         with open(output_filename, 'w') as html_file:
-            html_file.write(format_source(rel_src,
-                                          src,
-                                          annotation_sets[src_filename],
-                                          tpl,
-                                          web_path,
-                                          index_path))
+            format_source(html_file,
+                          rel_src,
+                          src,
+                          annotation_sets[src_filename],
+                          tpl,
+                          web_path,
+                          index_path)
+
+    # Each file is formatted independently, so overlap the file I/O.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(emit, input_files))
 
     web_path = os.path.relpath(web_dir, output_dir)
     with open(index_filename, 'w') as index_file:
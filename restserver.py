@@ -1,16 +1,85 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 from flask import Flask, Response, json
 from werkzeug.exceptions import NotFound
 from codeviewer import split_args, get_source_file_list, is_header, \
-    find_all_usrs
+    find_all_usrs, add_usrs
 import argparse
+import functools
+import hashlib
 import sys
-import os.path
+import os
 import clang.cindex as cindex
+import threading
+import time
+from collections import defaultdict
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask('codeviewer')
 codeviewer = None
 
+# Where parsed translation units are saved between runs of the server.
+AST_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'codeviewer')
+
+# Headers modified less than this long before parsing started aren't trusted
+# to be unchanged by the end of the parse, since file system timestamps are
+# coarser than time.time_ns() and can lag behind it.
+MTIME_SLACK_NS = 10**9
+
+
+def read_ast_deps(deps_filename):
+    """Return the diagnostics saved with an AST, or None if it's out of date.
+
+    The dependency file is JSON. It lists the modification time and name of
+    each file the AST was parsed from, and holds the diagnostics from parsing
+    it, which the AST itself doesn't keep. The AST is only valid if none of
+    those files have changed since."""
+    try:
+        with open(deps_filename, 'r') as deps_file:
+            deps = json.load(deps_file)
+        for (mtime, filename) in deps['files']:
+            if os.stat(filename).st_mtime_ns != mtime:
+                return None
+        return deps['diagnostics']
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_ast(tu, src, src_mtime, parse_start, diagnostics, ast_filename,
+             deps_filename):
+    """Save the translation unit so that a later run can load it.
+
+    src_mtime is the modification time of the source file, src, before it was
+    parsed, parse_start is time.time_ns() when parsing started, and
+    diagnostics are the diagnostics from parsing it. The includes can only be
+    checked after parsing, so if any of them may have been modified since
+    parsing started, nothing is saved. Failing to save isn't an error; the
+    file will just be parsed again next time."""
+    try:
+        os.makedirs(AST_CACHE_DIR, exist_ok=True)
+        # Never leave a dependency list that vouches for a half-written AST.
+        if os.path.exists(deps_filename):
+            os.remove(deps_filename)
+
+        files = [(src_mtime, src)]
+        for inclusion in tu.get_includes():
+            filename = inclusion.include.name
+            mtime = os.stat(filename).st_mtime_ns
+            if mtime >= parse_start - MTIME_SLACK_NS:
+                return
+            files.append((mtime, filename))
+
+        tu.save(ast_filename)
+        with open(deps_filename, 'w') as deps_file:
+            json.dump({'files': files, 'diagnostics': diagnostics}, deps_file)
+    except (OSError, cindex.TranslationUnitSaveError):
+        pass
+
 
 class CodeViewer:
     def __init__(self, input_dir, clang_args, libclang_path=None):
@@ -18,27 +87,177 @@ class CodeViewer:
             cindex.Config.set_library_path(libclang_path)
 
         self.input_dir = input_dir
+        self.clang_args = clang_args
         self.index = cindex.Index.create()
         self.tus = {}
 
+        # Guards the translation units and everything derived from them.
+        # Requests are served on several threads, and reparsing invalidates
+        # the cursors and tokens of a translation unit, so anything that calls
+        # into libclang holds this while it does.
+        self.lock = threading.RLock()
+
+        # The modification time of each source, by absolute filename, when its
+        # translation unit was last parsed.
+        self.parsed_mtimes = {}
+
+        # The absolute filenames of the sources whose translation units were
+        # loaded from saved ASTs, which can't be reparsed.
+        self.loaded_from_ast = set()
+
+        # The contents of each source that has been read, keyed by its name
+        # relative to the input directory, with the modification time of the
+        # file when it was read.
+        self.source_cache = {}
+
+        # The diagnostics from parsing each source, by absolute filename, as
+        # returned by get_tu_diagnostics. Saved ASTs don't keep diagnostics, so
+        # these are saved and loaded alongside them.
+        self.tu_diagnostics = {}
+
+        # The result of get_all_diagnostics, once it has been computed.
+        self.all_diagnostics = None
+
+        # The tokens in each source, keyed by file ID, as returned by
+        # get_tokens.
+        self.token_cache = {}
+
         self.abs_sources = get_source_file_list(self.input_dir)
+        self.abs_sources_set = frozenset(self.abs_sources)
         self.sources = [os.path.relpath(f, self.input_dir)
                         for f in self.abs_sources]
         self.filenames_to_ids = {src: i for i, src in enumerate(self.sources)}
         self.ids = set(range(len(self.sources)))
 
         def parse_tu(src):
-            if not is_header(src):
-                return self.index.parse(src, args=clang_args)
-            return self.index.parse(
-                src, args=clang_args,
-                options=cindex.TranslationUnit.PARSE_INCOMPLETE)
+            self.parsed_mtimes[src] = os.stat(src).st_mtime_ns
+            return self.load_tu(src)
 
-        self.tus = {rel: parse_tu(src)
-                    for rel, src in zip(self.sources, self.abs_sources)}
+        # Load the sources on a pool of threads, the same way generate_outputs
+        # parses them, so a cold start parses in parallel and a warm start
+        # reads the saved ASTs in parallel. Nothing is served until all of
+        # them are loaded, so the lock isn't needed yet.
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            self.tus = dict(zip(self.sources,
+                                executor.map(parse_tu, self.abs_sources)))
 
         self.usrs = find_all_usrs(self.tus, self.sources)
 
+        # The responses for the list of sources, which never changes, and for
+        # the list of USRs, once it has been encoded.
+        self.sources_json = encode_json(
+            [{'id': i, 'filename': f} for (i, f) in enumerate(self.sources)])
+        self.usrs_json = None
+
+    def get_parse_options(self, src):
+        """Return the options to parse the given source file with."""
+        # The preamble makes reparsing the file after it changes much faster.
+        options = cindex.TranslationUnit.PARSE_PRECOMPILED_PREAMBLE
+        if is_header(src):
+            options |= cindex.TranslationUnit.PARSE_INCOMPLETE
+        return options
+
+    def get_ast_filenames(self, src):
+        """Return the (ast_filename, deps_filename) to save the given source's
+        translation unit to.
+
+        Saved ASTs are keyed by the source file, the clang arguments, the
+        parse options, and the input directory, which the paths in the saved
+        diagnostics are relative to."""
+        options = self.get_parse_options(src)
+        key = '\0'.join([src, str(options), os.path.abspath(self.input_dir)] +
+                        self.clang_args)
+        key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return (os.path.join(AST_CACHE_DIR, key + '.ast'),
+                os.path.join(AST_CACHE_DIR, key + '.deps'))
+
+    def load_tu(self, src):
+        """Parse the given source file, or load it as saved by an earlier run.
+
+        Saved ASTs are only used if none of the files they were parsed from
+        have been modified since."""
+        (ast_filename, deps_filename) = self.get_ast_filenames(src)
+        diagnostics = read_ast_deps(deps_filename)
+        if diagnostics is not None:
+            try:
+                tu = cindex.TranslationUnit.from_ast_file(ast_filename,
+                                                          self.index)
+                self.tu_diagnostics[src] = diagnostics
+                self.loaded_from_ast.add(src)
+                return tu
+            except cindex.TranslationUnitLoadError:
+                pass
+
+        # Check the time before parsing, so that a change made while parsing
+        # makes the saved AST look out of date rather than current.
+        src_mtime = os.stat(src).st_mtime_ns
+        parse_start = time.time_ns()
+        tu = self.index.parse(src, args=self.clang_args,
+                              options=self.get_parse_options(src))
+        diagnostics = self.get_tu_diagnostics(tu)
+        self.tu_diagnostics[src] = diagnostics
+        self.loaded_from_ast.discard(src)
+        save_ast(tu, src, src_mtime, parse_start, diagnostics, ast_filename,
+                 deps_filename)
+        return tu
+
+    def get_tu_diagnostics(self, tu):
+        """Return the diagnostics in the translation unit that have a location.
+
+        Each diagnostic is a pair of the absolute name of the file it's in and
+        the diagnostic encoded as by ClangEncoder, so that it can be saved and
+        encoded as JSON directly."""
+        encoder = ClangEncoder(self.input_dir)
+        diagnostics = []
+        for diag in tu.diagnostics:
+            file = diag.location.file
+            if file is not None:
+                diagnostics.append([file.name,
+                                    encoder.encode_diagnostic(diag)])
+        return diagnostics
+
+    def refresh(self, idx):
+        """Parse the given source file again if it has been modified since its
+        translation unit was parsed.
+
+        Only the file itself is checked, not the headers it includes."""
+        src = self.id_to_filename(idx)
+        abs_src = self.id_to_abs_filename(idx)
+        with self.lock:
+            mtime = os.stat(abs_src).st_mtime_ns
+            if mtime == self.parsed_mtimes[abs_src]:
+                return
+
+            old_tu = self.tus[src]
+            if abs_src in self.loaded_from_ast:
+                # Translation units loaded from saved ASTs can't be reparsed,
+                # so parse the file from scratch instead.
+                self.tus[src] = self.load_tu(abs_src)
+            else:
+                tu = old_tu
+                parse_start = time.time_ns()
+                tu.reparse()
+                diagnostics = self.get_tu_diagnostics(tu)
+                self.tu_diagnostics[abs_src] = diagnostics
+                (ast_filename, deps_filename) = self.get_ast_filenames(abs_src)
+                save_ast(tu, abs_src, mtime, parse_start, diagnostics,
+                         ast_filename, deps_filename)
+            self.parsed_mtimes[abs_src] = mtime
+
+            # Everything derived from the old translation unit is stale, and
+            # reparsing invalidates its cursors.
+            self.all_diagnostics = None
+            self.token_cache.pop(idx, None)
+            self.usrs_json = None
+
+            # Only this translation unit's definitions need finding again, and
+            # definitions from other units are kept in preference to its own.
+            # One that was found in this unit first and is no longer in it is
+            # missing until the server restarts, even if another unit has it.
+            self.usrs = {usr: node for (usr, node) in self.usrs.items()
+                         if node.translation_unit is not old_tu}
+            add_usrs(self.usrs, self.tus[src])
+
     def id_to_filename(self, idx):
         return self.sources[idx]
 
@@ -46,9 +265,19 @@ class CodeViewer:
         return self.filenames_to_ids[idx]
 
     def read_source(self, src):
-        """Return the contents of the given source file."""
-        with open(os.path.join(self.input_dir, src), 'r') as f:
-            return f.read()
+        """Return the contents of the given source file.
+
+        The file is only read again if it has been modified since it was last
+        read."""
+        filename = os.path.join(self.input_dir, src)
+        mtime = os.stat(filename).st_mtime_ns
+        cached = self.source_cache.get(src)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(filename, 'r') as f:
+            contents = f.read()
+        self.source_cache[src] = (mtime, contents)
+        return contents
 
     def get_tu_from_id(self, idx):
         return self.tus[self.id_to_filename(idx)]
@@ -56,83 +285,173 @@ class CodeViewer:
     def id_to_abs_filename(self, idx):
         return self.abs_sources[idx]
 
+    def get_tokens(self, idx):
+        """Return the tokens in the given source file.
+
+        Each token is a dict of its extent, spelling and kind, with the extent
+        already converted so that it can be encoded as JSON directly. The
+        tokens only change when the file is parsed, so each file is only
+        tokenized once."""
+        with self.lock:
+            tokens = self.token_cache.get(idx)
+            if tokens is not None:
+                return tokens
+
+            tu = self.get_tu_from_id(idx)
+            abs_filename = self.id_to_abs_filename(idx)
+            contents = self.read_source(self.id_to_filename(idx))
+            extent = tu.get_extent(abs_filename, (0, len(contents)))
+            encoder = ClangEncoder(self.input_dir)
+            tokens = [{
+                'extent': encoder.encode_range(token.extent),
+                'spelling': token.spelling,
+                'kind': token.kind.name,
+            } for token in tu.get_tokens(extent=extent)]
+            self.token_cache[idx] = tokens
+            return tokens
+
+    def get_usrs_json(self):
+        """Return the names of all USRs, encoded as JSON."""
+        with self.lock:
+            if self.usrs_json is None:
+                usrs = {usr: node.displayname
+                        for usr, node in self.usrs.items()}
+                self.usrs_json = encode_json({'usrs': usrs})
+            return self.usrs_json
+
     def get_all_diagnostics(self):
         """Collect all diagnostics across translation units.
 
-        The return value is a dictionary mapping from file ID to a set of
-        Diagnostic objects. Diagnostics occurring in files that are not indexed
-        are ignored. Duplicate diagnostics are ignored.
-        """
+        The return value is a dictionary mapping from absolute filename to a
+        list of diagnostics, encoded as by ClangEncoder. Diagnostics occurring
+        in files that are not indexed are ignored. Duplicate diagnostics, such
+        as those in a header included by several sources, are ignored.
 
-        diags = {}
-        for tu in self.tus.itervalues():
-            for diag in tu.diagnostics:
-                if diag.location.file is None:
+        The diagnostics only change when translation units are parsed, so they
+        are only collected once.
+        """
+        with self.lock:
+            if self.all_diagnostics is not None:
+                return self.all_diagnostics
+
+            diags = defaultdict(dict)
+            all_tu_diags = chain.from_iterable(self.tu_diagnostics.values())
+            for (filename, diag) in all_tu_diags:
+                if filename not in self.abs_sources_set:
                     continue
 
-                filename = diag.location.file.name
-                if filename not in self.abs_sources:
-                    continue
+                location = diag['location']
+                key = (diag['severity'], location['line'], location['column'],
+                       diag['spelling'])
+                diags[filename].setdefault(key, diag)
+
+            # Looking up a file without diagnostics should raise KeyError
+            # rather than add it.
+            self.all_diagnostics = {
+                filename: list(file_diags.values())
+                for (filename, file_diags) in diags.items()}
+            return self.all_diagnostics
+
+
+@functools.lru_cache(maxsize=4096)
+def relpath(filename, rel_dir):
+    """Return os.path.relpath(filename, rel_dir), remembering the result.
 
-                if filename not in diags:
-                    diags[filename] = set()
-                diags[filename].add(diag)
+    The same few files come up over and over again when encoding locations."""
+    return os.path.relpath(filename, rel_dir)
 
-        return diags
 
+class ClangEncoder:
+    """Converts clang cindex objects to plain values that can be encoded as
+    JSON.
+
+    The conversion calls into libclang, so it has to happen while the objects'
+    translation unit is still valid, rather than while a response is being
+    encoded."""
+
+    # The name of each diagnostic severity.
+    SEVERITY_STRS = {
+        cindex.Diagnostic.Ignored: 'Ignored',
+        cindex.Diagnostic.Note: 'Note',
+        cindex.Diagnostic.Warning: 'Warning',
+        cindex.Diagnostic.Error: 'Error',
+        cindex.Diagnostic.Fatal: 'Fatal',
+    }
 
-class ClangEncoder(json.JSONEncoder):
-    """JSON encoder for clang cindex objects."""
     def __init__(self, rel_dir):
-        json.JSONEncoder.__init__(self)
         self.rel_dir = rel_dir
 
-    def default(self, obj):
-        if isinstance(obj, cindex.File):
-            return os.path.relpath(obj.name, self.rel_dir)
-
-        if isinstance(obj, cindex.SourceRange):
-            return {
-                'start': self.default(obj.start),
-                'end': self.default(obj.end),
-            }
-
-        if isinstance(obj, cindex.SourceLocation):
-            return {
-                'file': self.default(obj.file),
-                'line': obj.line,
-                'column': obj.column,
-            }
-
-        if isinstance(obj, cindex.Diagnostic):
-            severity_strs = {
-                cindex.Diagnostic.Ignored: 'Ignored',
-                cindex.Diagnostic.Note: 'Note',
-                cindex.Diagnostic.Warning: 'Warning',
-                cindex.Diagnostic.Error: 'Error',
-                cindex.Diagnostic.Fatal: 'Fatal',
-            }
-            js = {
-                'severity': severity_strs[obj.severity],
-                'location': self.default(obj.location),
-                'spelling': obj.spelling
-            }
-
-            ranges = [self.default(r) for r in obj.ranges]
-            if ranges:
-                js['ranges'] = ranges
-
-            return js
-
-        return json.JSONEncoder.default(self, obj)
+    def encode_file(self, obj):
+        if obj is None:
+            return None
+        return relpath(obj.name, self.rel_dir)
+
+    def encode_location(self, obj):
+        return {
+            'file': self.encode_file(obj.file),
+            'line': obj.line,
+            'column': obj.column,
+        }
+
+    def encode_range(self, obj):
+        return {
+            'start': self.encode_location(obj.start),
+            'end': self.encode_location(obj.end),
+        }
+
+    def encode_diagnostic(self, obj):
+        js = {
+            'severity': self.SEVERITY_STRS[obj.severity],
+            'location': self.encode_location(obj.location),
+            'spelling': obj.spelling
+        }
+
+        ranges = [self.encode_range(r) for r in obj.ranges]
+        if ranges:
+            js['ranges'] = ranges
+
+        return js
+
+
+def encode_json(obj):
+    """Return obj encoded as JSON, using orjson if it's installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj)
+
+
+def iter_json(obj):
+    """Yield the UTF-8 JSON encoding of obj, a dict, in pieces.
+
+    Each value is encoded separately with encode_json, and lists are split
+    into one piece per item, so a large response is never encoded as a single
+    string. The pieces are encoded after the caller has returned, so obj must
+    only hold plain values, not clang objects."""
+    def encode(value):
+        js = encode_json(value)
+        return js if isinstance(js, bytes) else js.encode('utf-8')
+
+    sep = b'{'
+    for (key, value) in obj.items():
+        yield sep
+        sep = b','
+        yield encode(key)
+        yield b':'
+        if isinstance(value, list):
+            item_sep = b'['
+            for item in value:
+                yield item_sep
+                item_sep = b','
+                yield encode(item)
+            yield b'[]' if item_sep == b'[' else b']'
+        else:
+            yield encode(value)
+    yield b'{}' if sep == b'{' else b'}'
 
 
 @app.route('/api/sources')
 def api_sources():
-    sources = [{'id': codeviewer.filename_to_id(f), 'filename': f}
-               for f in codeviewer.sources]
-    js = json.dumps(sources)
-    resp = Response(js, mimetype='application/json')
+    resp = Response(codeviewer.sources_json, mimetype='application/json')
     return resp
 
 
@@ -143,6 +462,7 @@ def api_show_source(idx):
         filename = codeviewer.id_to_filename(idx)
     except:
         raise NotFound()
+    codeviewer.refresh(idx)
 
     obj = {
         'filename': filename,
@@ -152,61 +472,56 @@ def api_show_source(idx):
 
     abs_filename = codeviewer.id_to_abs_filename(idx)
     try:
-        diags = list(codeviewer.get_all_diagnostics()[abs_filename])
+        diags = codeviewer.get_all_diagnostics()[abs_filename]
     except KeyError:
         diags = []
     if diags:
         obj['diagnostics'] = diags
 
     try:
-        tu = codeviewer.get_tu_from_id(idx)
+        obj['tokens'] = codeviewer.get_tokens(idx)
     except KeyError:
-        tu = None
-
-    if tu:
-        extent = tu.get_extent(abs_filename, (0, len(obj['contents'])))
-        tokens = []
-        for token in tu.get_tokens(extent=extent):
-            tokens.append({
-                'extent': token.extent,
-                'spelling': token.spelling,
-                'kind': token.kind.name,
-            })
-        obj['tokens'] = tokens
+        pass
 
     def cursor_in_file(cursor):
         if cursor.location.file is None:
             return False
         return cursor.location.file.name == abs_filename
 
-    usrs = {
-        usr: {'displayname': node.displayname, 'extent': node.extent}
-        for usr, node in codeviewer.usrs.items() if
-        cursor_in_file(node)}
+    # The response is encoded after the lock is released, so convert the
+    # extents while the cursors are still valid.
+    encoder = ClangEncoder(codeviewer.input_dir)
+    with codeviewer.lock:
+        usrs = {
+            usr: {'displayname': node.displayname,
+                  'extent': encoder.encode_range(node.extent)}
+            for usr, node in codeviewer.usrs.items() if
+            cursor_in_file(node)}
     obj['usrs'] = usrs
 
-    js = ClangEncoder(codeviewer.input_dir).encode(obj)
+    # Stream the response, since the tokens of a large file can add up.
+    js = iter_json(obj)
     resp = Response(js, mimetype='application/json')
     return resp
 
 
 @app.route('/api/usrs')
 def api_usrs():
-    usrs = {usr: node.displayname for usr, node in codeviewer.usrs.iteritems()}
-    js = json.dumps({'usrs': usrs})
-    resp = Response(js, mimetype='application/json')
+    resp = Response(codeviewer.get_usrs_json(), mimetype='application/json')
     return resp
 
 
 @app.route('/api/usrs/usr/<usr>')
 def api_show_usr(usr):
-    node = codeviewer.usrs[usr]
-    nodeobj = {
-        'usr': usr,
-        'displayname': node.displayname,
-        'extent': node.extent
-    }
-    js = ClangEncoder(codeviewer.input_dir).encode({'node': nodeobj})
+    encoder = ClangEncoder(codeviewer.input_dir)
+    with codeviewer.lock:
+        node = codeviewer.usrs[usr]
+        nodeobj = {
+            'usr': usr,
+            'displayname': node.displayname,
+            'extent': encoder.encode_range(node.extent)
+        }
+    js = encode_json({'node': nodeobj})
     resp = Response(js, mimetype='application/json')
     return resp
 
@@ -0,0 +1,507 @@
+import io
+import os
+import tempfile
+import unittest
+from string import Template
+
+import clang.cindex as cindex
+
+from codeviewer import (CompiledTemplate, EntireLineSourceLocation,
+                        HTMLAnnotationSet, LineAndColumn, OffsetList,
+                        PieceTable, Rewriter, format_source,
+                        get_line_diagnostics, get_source_file_list,
+                        load_template, sanitize_code_as_html, split_args)
+
+
+class TestOffsetList(unittest.TestCase):
+    def test_insert(self):
+        ol = OffsetList()
+
+        # Inserting before the beginning should offset everything.
+        # ____01234
+        ol.insert(0, 4)
+        for i in range(5):
+            self.assertEqual(ol.get_rewritten_pos(i), i+4)
+
+        # ____01_234
+        ol.insert(2, 1)
+        for i in range(2):
+            self.assertEqual(ol.get_rewritten_pos(i), i+4)
+        for i in range(2, 5):
+            self.assertEqual(ol.get_rewritten_pos(i), i+5)
+
+    def test_remove(self):
+        ol = OffsetList()
+
+        # Remove two characters from the beginning.
+        # 234
+        ol.remove(0, 2)
+        for i in range(2):
+            self.assertEqual(ol.get_rewritten_pos(i), 0)
+        for i in range(2, 5):
+            self.assertEqual(ol.get_rewritten_pos(i), i-2)
+
+    def test_grow(self):
+        ol = OffsetList(2)
+
+        # Editing past the initial size should keep the earlier edits.
+        # _0123456789__
+        ol.insert(0, 1)
+        ol.insert(10, 2)
+        self.assertEqual(ol.get_rewritten_pos(0), 1)
+        self.assertEqual(ol.get_rewritten_pos(9), 10)
+        self.assertEqual(ol.get_rewritten_pos(10), 13)
+
+    def test_out_of_order(self):
+        ol = OffsetList()
+
+        # Edits can arrive in any column order.
+        # _0__1234 with 3 removed
+        ol.remove(3, 1)
+        ol.insert(1, 2)
+        ol.insert(0, 1)
+        self.assertEqual([ol.get_rewritten_pos(i) for i in range(5)],
+                         [1, 4, 5, 6, 6])
+
+    def test_query(self):
+        ol = OffsetList()
+
+        # __01_234
+        ol.insert(0, 2)
+        ol.insert(2, 1)
+        self.assertEqual(ol.query(0), (2, 2))
+        self.assertEqual(ol.query(1), (3, 0))
+        self.assertEqual(ol.query(2), (5, 1))
+
+
+class TestPieceTable(unittest.TestCase):
+    def test_insert(self):
+        pt = PieceTable("0123")
+        pt.insert(2, "ab")
+        self.assertEqual(str(pt), "01ab23")
+        pt.insert(3, "c")
+        self.assertEqual(str(pt), "01acb23")
+        pt.insert(7, "!")
+        self.assertEqual(str(pt), "01acb23!")
+
+    def test_delete(self):
+        pt = PieceTable("012345")
+        pt.insert(3, "ab")
+        pt.delete(2, 4)
+        self.assertEqual(str(pt), "01b345")
+        pt.delete(0, 6)
+        self.assertEqual(str(pt), "")
+
+    def test_empty(self):
+        pt = PieceTable("")
+        pt.insert(0, "a")
+        self.assertEqual(str(pt), "a")
+
+    def test_past_end(self):
+        pt = PieceTable("0123")
+        pt.delete(1, 4)
+        pt.insert(4, "a")
+        self.assertEqual(str(pt), "0a")
+        pt.delete(1, 9)
+        self.assertEqual(str(pt), "0")
+        pt.replace(3, 5, "b")
+        self.assertEqual(str(pt), "0b")
+        pt.insert(-1, "c")
+        self.assertEqual(str(pt), "c0b")
+        pt.delete(-2, 1)
+        self.assertEqual(str(pt), "0b")
+
+    def test_rewriter_past_removal(self):
+        rw = Rewriter("abcd")
+        rw.insert_after("X", 0, 2)
+        rw.remove(0, 0, 0, 4)
+        rw.insert_after("Y", 0, 4)
+        self.assertEqual(rw.lines, ["Y"])
+
+        # The rewritten column of an insert_before can end up before the
+        # start of the line, which must not bring removed text back.
+        for (src, expected) in [("ba", ["Z2"]), ("bac", ["Z2c"])]:
+            rw = Rewriter(src)
+            rw.insert_before("X0", 0, 1)
+            rw.remove(0, 0, 0, 2)
+            rw.insert_before("Z2", 0, 1)
+            self.assertEqual(rw.lines, expected)
+
+
+class TestRewriter(unittest.TestCase):
+    def test_lines(self):
+        # Reading lines must not recurse, with or without edits.
+        rw = Rewriter("ab\n\ncd")
+        self.assertEqual(rw.lines, ["ab", "", "cd"])
+        rw.insert_after("_", line=1, col=0)
+        self.assertEqual(rw.lines, ["ab", "_", "cd"])
+
+        # The rewritten lines can only be changed through the rewriter.
+        with self.assertRaises(AttributeError):
+            rw.lines = []
+
+    def test_single_line(self):
+        rw = Rewriter("test")
+        rw.insert_before("_", line=0, col=2)
+        self.assertEqual(rw.lines[0], "te_st")
+
+        # Now inserting after where we already did should be properly offset.
+        rw.insert_before("$$", line=0, col=3)
+        self.assertEqual(rw.lines[0], "te_s$$t")
+
+        # Now try inserting before either point.
+        rw.insert_before("%%%", line=0, col=1)
+        self.assertEqual(rw.lines[0], "t%%%e_s$$t")
+
+        # Now try the very end.
+        rw.insert_before("!", line=0, col=4)
+        self.assertEqual(rw.lines[0], "t%%%e_s$$t!")
+
+    def test_before_after(self):
+        rw = Rewriter("0123")
+        rw.insert_before("b", line=0, col=2)
+        self.assertEqual(rw.lines[0], "01b23")
+
+        rw.insert_before("a", line=0, col=2)
+        self.assertEqual(rw.lines[0], "01ab23")
+
+        rw.insert_after("c", line=0, col=2)
+        self.assertEqual(rw.lines[0], "01abc23")
+
+    def test_negative_col(self):
+        rw = Rewriter("0123")
+        rw.insert_before("4", line=0, col=-1)
+        self.assertEqual(rw.lines[0], "01234")
+
+    def test_remove(self):
+        rw = Rewriter("012345")
+        rw.remove(from_line=0, from_col=2, to_line=0, to_col=4)
+        self.assertEqual(rw.lines[0], "0145")
+
+    def test_replace(self):
+        rw = Rewriter("01xx45")
+        rw.replace("23", from_line=0, from_col=2, to_line=0, to_col=4)
+        self.assertEqual(rw.lines[0], "012345")
+
+    def test_two_replacements(self):
+        rw = Rewriter("#include <iostream>")
+        rw.replace("&lt;", 0, 9, 0, 10)
+        self.assertEqual(rw.lines[0], "#include &lt;iostream>")
+        rw.replace("&gt;", 0, 18, 0, 19)
+        self.assertEqual(rw.lines[0], "#include &lt;iostream&gt;")
+
+    def test_two_consecutive_replacements(self):
+        rw = Rewriter('  std::cout << "Hello, world!";')
+        rw.replace("&lt;", 0, 12, 0, 13)
+        self.assertEqual(rw.lines[0], '  std::cout &lt;< "Hello, world!";')
+        rw.replace("&lt;", 0, 13, 0, 14)
+        self.assertEqual(rw.lines[0], '  std::cout &lt;&lt; "Hello, world!";')
+
+    def test_replace_after_edits(self):
+        # Replacing must match removing and then inserting after.
+        for (text, from_col, to_col) in [("x", 2, 3), ("", 2, 3),
+                                         ("yz", 3, 3), ("w", 3, -1)]:
+            replaced = Rewriter("abcd")
+            removed = Rewriter("abcd")
+            for rw in (replaced, removed):
+                rw.insert_after("<", 0, 0)
+                rw.insert_before(">", 0, 1)
+                rw.replace("B", 0, 1, 0, 2)
+            replaced.replace(text, 0, from_col, 0, to_col)
+            removed.remove(0, from_col, 0, to_col)
+            removed.insert_after(text, 0, from_col)
+            self.assertEqual(replaced.lines, removed.lines)
+            replaced.insert_before("!", 0, 0)
+            removed.insert_before("!", 0, 0)
+            self.assertEqual(replaced.lines, removed.lines)
+
+    def test_commit(self):
+        rw = Rewriter("0123\n#include <iostream>")
+        rw.commit([
+            (0, 2, Rewriter.INSERT_BEFORE, "b"),
+            (0, 2, Rewriter.INSERT_BEFORE, "a"),
+            (0, 2, Rewriter.INSERT_AFTER, "c"),
+            (0, -1, Rewriter.INSERT_AFTER, "4"),
+            (1, 9, Rewriter.REMOVE, 10),
+            (1, 9, Rewriter.INSERT_AFTER, "&lt;"),
+            (1, 18, Rewriter.REMOVE, 19),
+            (1, 18, Rewriter.INSERT_AFTER, "&gt;"),
+        ])
+        self.assertEqual(rw.lines, ["01abc234", "#include &lt;iostream&gt;"])
+
+    def test_commit_matches_interactive(self):
+        src = "<a>b<c>"
+        edits = [
+            (0, 0, Rewriter.REMOVE, 1),
+            (0, 0, Rewriter.INSERT_AFTER, "&lt;"),
+            (0, 0, Rewriter.INSERT_BEFORE, "<i>"),
+            (0, 2, Rewriter.REMOVE, 3),
+            (0, 2, Rewriter.INSERT_AFTER, "&gt;"),
+            (0, 3, Rewriter.INSERT_AFTER, "</i>"),
+            (0, 4, Rewriter.REMOVE, 7),
+        ]
+
+        interactive = Rewriter(src)
+        for (line, col, kind, arg) in edits:
+            if kind == Rewriter.INSERT_BEFORE:
+                interactive.insert_before(arg, line, col)
+            elif kind == Rewriter.INSERT_AFTER:
+                interactive.insert_after(arg, line, col)
+            else:
+                interactive.remove(line, col, line, arg)
+
+        batch = Rewriter(src)
+        batch.commit(edits)
+        self.assertEqual(batch.lines, interactive.lines)
+
+    def test_commit_keeps_insertions_at_removals(self):
+        rw = Rewriter("c")
+        rw.commit([(0, 1, Rewriter.INSERT_AFTER, "X0"),
+                   (0, 0, Rewriter.REMOVE, 1)])
+        self.assertEqual(rw.lines, ["X0"])
+
+        rw = Rewriter("abcd")
+        rw.commit([(0, 1, Rewriter.INSERT_BEFORE, "<"),
+                   (0, 2, Rewriter.INSERT_AFTER, "!"),
+                   (0, 3, Rewriter.INSERT_AFTER, ">"),
+                   (0, 1, Rewriter.REMOVE, 3)])
+        self.assertEqual(rw.lines, ["a<!>d"])
+
+    def test_no_edits_after_commit(self):
+        rw = Rewriter("ab")
+        rw.commit([(0, 0, Rewriter.INSERT_BEFORE, "<x>")])
+        with self.assertRaises(AssertionError):
+            rw.insert_after("!", 0, 1)
+        with self.assertRaises(AssertionError):
+            rw.commit([])
+        self.assertEqual(rw.lines, ["<x>ab"])
+
+    def test_commit_escape(self):
+        rw = Rewriter("a<b\nc>d")
+        rw.commit([(0, 1, Rewriter.INSERT_BEFORE, "<i>"),
+                   (0, 2, Rewriter.INSERT_AFTER, "</i>")],
+                  escape=sanitize_code_as_html)
+        self.assertEqual(rw.lines, ["a<i>&lt;</i>b", "c&gt;d"])
+
+    def test_commit_escape_after_edits(self):
+        # Escaping rebuilds every line, which would lose earlier edits.
+        rw = Rewriter("ab\ncd")
+        rw.insert_after("!", 1, 1)
+        with self.assertRaises(AssertionError):
+            rw.commit([(0, 0, Rewriter.INSERT_BEFORE, "<")], escape=str)
+
+
+class TestGetLineDiagnostics(unittest.TestCase):
+    class File:
+        def __init__(self, name):
+            self.name = name
+
+    class Location:
+        def __init__(self, file, line):
+            self.file = file
+            self.line = line
+
+    class Diagnostic:
+        def __init__(self, severity, spelling, file=None, line=0):
+            self.severity = severity
+            self.spelling = spelling
+            self.location = TestGetLineDiagnostics.Location(file, line)
+
+    class TranslationUnit:
+        def __init__(self, diagnostics):
+            self.diagnostics = diagnostics
+
+    def test_severities(self):
+        src = self.File('a.c')
+        tu = self.TranslationUnit([
+            self.Diagnostic(cindex.Diagnostic.Note, 'note', src, 1),
+            self.Diagnostic(cindex.Diagnostic.Warning, 'warn', src, 1),
+            self.Diagnostic(cindex.Diagnostic.Warning, 'warn', src, 1),
+            self.Diagnostic(cindex.Diagnostic.Error, 'err', src, 2),
+            self.Diagnostic(cindex.Diagnostic.Fatal, 'fatal', src, 2),
+            self.Diagnostic(cindex.Diagnostic.Error, 'nowhere'),
+        ])
+        self.assertEqual(get_line_diagnostics({'a.c': tu}),
+                         {'a.c': {1: {('warning', 'warn')},
+                                  2: {('error', 'err'),
+                                      ('error', 'fatal')}}})
+
+    def test_plain_dicts(self):
+        src = self.File('a.c')
+        tu = self.TranslationUnit([
+            self.Diagnostic(cindex.Diagnostic.Warning, 'warn', src, 1),
+        ])
+        diags = get_line_diagnostics({'a.c': tu})
+        self.assertIs(type(diags), dict)
+        self.assertIs(type(diags['a.c']), dict)
+        with self.assertRaises(KeyError):
+            diags['b.c']
+        with self.assertRaises(KeyError):
+            diags['a.c'][2]
+
+
+class TestHTMLAnnotationSet(unittest.TestCase):
+    class Extent:
+        def __init__(self, start_line, start_col, end_line, end_col):
+            self.start = LineAndColumn(start_line, start_col)
+            self.end = LineAndColumn(end_line, end_col)
+
+    def format(self, src, tags):
+        annotation_set = HTMLAnnotationSet()
+        for (tag, extent) in tags:
+            annotation_set.add_tag(tag, [], self.Extent(*extent))
+        rw = Rewriter(src)
+        edits = []
+        annotation_set.apply(rw, edits)
+        rw.commit(edits)
+        return rw.lines
+
+    def test_nested(self):
+        # Tags that start together open outermost first, whatever the order
+        # they were added in.
+        self.assertEqual(self.format("abcd", [('i', (1, 1, 1, 3)),
+                                              ('b', (1, 1, 1, 5))]),
+                         ["<b><i>ab</i>cd</b>"])
+
+    def test_adjacent(self):
+        self.assertEqual(self.format("abcd", [('i', (1, 3, 1, 5)),
+                                              ('b', (1, 1, 1, 3))]),
+                         ["<b>ab</b><i>cd</i>"])
+
+    def test_crossing(self):
+        self.assertEqual(self.format("abcd", [('b', (1, 1, 1, 4)),
+                                              ('i', (1, 2, 1, 5))]),
+                         ["<b>a<i>bc</i></b><i>d</i>"])
+
+    def test_entire_line(self):
+        annotation_set = HTMLAnnotationSet()
+        annotation_set.add_tag('b', [], EntireLineSourceLocation(2))
+        annotation_set.add_tag('i', [], self.Extent(1, 3, 2, 2))
+        rw = Rewriter("ab\ncd")
+        edits = []
+        annotation_set.apply(rw, edits)
+        rw.commit(edits)
+        self.assertEqual(rw.lines, ["ab<i>", "<b>c</b></i><b>d</b>"])
+
+    def test_attributes(self):
+        annotation_set = HTMLAnnotationSet()
+        annotation_set.add_tag('span',
+                               [('class', 'error'), ('title', 'a "<b>" & c')],
+                               self.Extent(1, 1, 1, 2))
+        rw = Rewriter("ab")
+        edits = []
+        annotation_set.apply(rw, edits)
+        rw.commit(edits)
+        self.assertEqual(rw.lines,
+                         ['<span class="error" '
+                          'title="a &quot;&lt;b&gt;&quot; &amp; c">a</span>b'])
+
+    def test_split_id(self):
+        # Only the first piece of a split tag keeps its id.
+        annotation_set = HTMLAnnotationSet()
+        annotation_set.add_tag('b', [], self.Extent(1, 1, 1, 4))
+        annotation_set.add_tag('span', [('id', 'x'), ('class', 'c')],
+                               self.Extent(1, 2, 1, 5))
+        rw = Rewriter("abcd")
+        edits = []
+        annotation_set.apply(rw, edits)
+        rw.commit(edits)
+        self.assertEqual(rw.lines,
+                         ['<b>a<span id="x" class="c">bc</span></b>'
+                          '<span class="c">d</span>'])
+
+
+class TestCompiledTemplate(unittest.TestCase):
+    def test_substitute(self):
+        text = '<a href="$url">${name}s</a> cost $$5, $$$price'
+        values = {'url': 'x.html', 'name': 'foo', 'price': 3}
+        self.assertEqual(CompiledTemplate(text).substitute(**values),
+                         Template(text).substitute(**values))
+
+    def test_write(self):
+        text = '<a href="$url">${name}s</a> cost $$5, $$$price'
+        values = {'url': 'x.html', 'name': 'foo', 'price': 3}
+        out = io.StringIO()
+        CompiledTemplate(text).write(out, **values)
+        self.assertEqual(out.getvalue(), Template(text).substitute(**values))
+
+    def test_missing_value(self):
+        with self.assertRaises(KeyError):
+            CompiledTemplate('$a $b').substitute(a='1')
+
+    def test_invalid_placeholder(self):
+        with self.assertRaises(ValueError):
+            CompiledTemplate('$ not a name')
+
+
+class TestLoadTemplate(unittest.TestCase):
+    def test_reload_when_modified(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tpl_filename = os.path.join(tmp_dir, 'page.html')
+            with open(tpl_filename, 'w') as tpl_file:
+                tpl_file.write('old $x')
+            os.utime(tpl_filename, ns=(0, 0))
+            tpl = load_template(tpl_filename)
+            self.assertIs(load_template(tpl_filename), tpl)
+
+            with open(tpl_filename, 'w') as tpl_file:
+                tpl_file.write('new $x')
+            os.utime(tpl_filename, ns=(0, 1))
+            self.assertEqual(load_template(tpl_filename).substitute(x=1),
+                             'new 1')
+
+
+class TestFormatSource(unittest.TestCase):
+    def format(self, src, annotation_set):
+        out = io.StringIO()
+        tpl = CompiledTemplate('$filename|$web_path|$index_path|$code')
+        format_source(out, 'a.c', src, annotation_set, tpl, 'web',
+                      'index.html')
+        return out.getvalue()
+
+    def test_no_tags(self):
+        self.assertEqual(self.format('a<b\r\nc&d\n', HTMLAnnotationSet()),
+                         'a.c|web|index.html|a&lt;b\nc&amp;d')
+
+    def test_tags(self):
+        annotation_set = HTMLAnnotationSet()
+        annotation_set.add_tag('b', [], EntireLineSourceLocation(2))
+        self.assertEqual(self.format('a<b\r\nc&d\n', annotation_set),
+                         'a.c|web|index.html|a&lt;b\n<b>c&amp;d</b>')
+
+
+class TestSplitArgs(unittest.TestCase):
+    def test_no_args(self):
+        self.assertEqual(split_args([]), ([], []))
+
+    def test_both_args(self):
+        our_args = ['--a', 'foo']
+        clang_args = ['-Wall', '-Wextra', '--', 'bar']
+        self.assertEqual(split_args(our_args + ['--'] + clang_args),
+                         (our_args, clang_args))
+
+    def test_no_clang_args(self):
+        our_args = ['--a', 'foo']
+        self.assertEqual(split_args(our_args), (our_args, []))
+        self.assertEqual(split_args(our_args + ['--']), (our_args, []))
+
+
+class TestGetSourceFileList(unittest.TestCase):
+    def test_nested(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(os.path.join(tmp_dir, 'b', 'c'))
+            os.makedirs(os.path.join(tmp_dir, 'd.h'))
+            for name in ['a.cpp', 'a.txt', 'Makefile',
+                         os.path.join('b', 'c', 'e.h'),
+                         os.path.join('b', 'f.mm')]:
+                open(os.path.join(tmp_dir, name), 'w').close()
+
+            root = os.path.abspath(tmp_dir)
+            self.assertEqual(get_source_file_list(tmp_dir),
+                             [os.path.join(root, 'a.cpp'),
+                              os.path.join(root, 'b', 'c', 'e.h'),
+                              os.path.join(root, 'b', 'f.mm')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,348 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import clang.cindex as cindex
+
+import restserver
+from restserver import CodeViewer, iter_json, read_ast_deps, save_ast
+
+
+class File:
+    def __init__(self, name):
+        self.name = name
+
+
+class Location:
+    def __init__(self, file, line, column):
+        self.file = file
+        self.line = line
+        self.column = column
+
+
+class Diagnostic:
+    def __init__(self, severity, spelling, location):
+        self.severity = severity
+        self.spelling = spelling
+        self.location = location
+        self.ranges = []
+
+
+class Inclusion:
+    def __init__(self, filename):
+        self.include = File(filename)
+
+
+class CursorKind:
+    def is_declaration(self):
+        return True
+
+
+class Cursor:
+    """A definition, or the root of a translation unit if usr is None."""
+    def __init__(self, tu, usr=None, children=()):
+        self.translation_unit = tu
+        self.usr = usr
+        self.kind = CursorKind()
+        self.children = list(children)
+        self.walks = 0
+
+    def walk_preorder(self):
+        self.walks += 1
+        return self.children
+
+    def get_usr(self):
+        return self.usr
+
+    def get_definition(self):
+        return self
+
+
+class TranslationUnit:
+    def __init__(self, diagnostics=(), usrs=(), includes=()):
+        self.diagnostics = list(diagnostics)
+        self.usrs = usrs
+        self.includes = includes
+        self.cursor = self.make_cursor()
+        self.reparses = 0
+
+    def make_cursor(self):
+        return Cursor(self, children=[Cursor(self, usr)
+                                      for usr in self.usrs])
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            f.write('ast')
+
+    def get_includes(self):
+        return [Inclusion(filename) for filename in self.includes]
+
+    def reparse(self):
+        # Reparsing invalidates the old cursors.
+        self.reparses += 1
+        self.cursor = self.make_cursor()
+
+
+class Index:
+    """An index whose parses produce a warning at the start of each file, and
+    define one USR named after the file and one shared by all files."""
+    def __init__(self):
+        self.parses = []
+
+    def parse(self, src, args=None, options=0):
+        self.parses.append(src)
+        location = Location(File(src), 1, 1)
+        return TranslationUnit([
+            Diagnostic(cindex.Diagnostic.Warning, 'warn', location),
+        ], ['c:@' + os.path.basename(src), 'c:@shared'])
+
+
+class CodeViewerTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.input_dir = os.path.join(tmp_dir.name, 'input')
+        os.mkdir(self.input_dir)
+        self.src = os.path.join(self.input_dir, 'a.c')
+        with open(self.src, 'w') as f:
+            f.write('int a;\n')
+
+        cache_dir = os.path.join(tmp_dir.name, 'cache')
+        patcher = mock.patch.object(restserver, 'AST_CACHE_DIR', cache_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Loaded translation units have no diagnostics of their own.
+        self.from_ast_file = mock.Mock(
+            side_effect=lambda filename, index: TranslationUnit())
+        patcher = mock.patch.object(cindex.TranslationUnit, 'from_ast_file',
+                                    self.from_ast_file)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create(self):
+        """Return a CodeViewer for the input directory and its index."""
+        index = Index()
+        with mock.patch.object(cindex.Index, 'create', return_value=index):
+            return (CodeViewer(self.input_dir, []), index)
+
+    def touch(self, filename):
+        mtime = os.stat(filename).st_mtime_ns + 10**9
+        os.utime(filename, ns=(mtime, mtime))
+
+    def assertHasWarning(self, viewer):
+        diags = viewer.get_all_diagnostics()
+        self.assertEqual(diags, {self.src: [{
+            'severity': 'Warning',
+            'location': {'file': 'a.c', 'line': 1, 'column': 1},
+            'spelling': 'warn',
+        }]})
+
+
+class TestSavedASTs(CodeViewerTestCase):
+    def test_load_keeps_diagnostics(self):
+        (viewer, index) = self.create()
+        self.assertEqual(index.parses, [self.src])
+        self.assertHasWarning(viewer)
+
+        (viewer, index) = self.create()
+        self.assertEqual(index.parses, [])
+        self.assertEqual(self.from_ast_file.call_count, 1)
+        self.assertHasWarning(viewer)
+
+    def test_stale_deps(self):
+        self.create()
+        self.touch(self.src)
+        (viewer, index) = self.create()
+        self.assertEqual(index.parses, [self.src])
+        self.assertFalse(self.from_ast_file.called)
+        self.assertHasWarning(viewer)
+
+    def test_corrupt_deps(self):
+        (viewer, _) = self.create()
+        (_, deps_filename) = viewer.get_ast_filenames(self.src)
+        with open(deps_filename, 'w') as f:
+            f.write('123 {}\n'.format(self.src))
+        (viewer, index) = self.create()
+        self.assertEqual(index.parses, [self.src])
+        self.assertFalse(self.from_ast_file.called)
+        self.assertHasWarning(viewer)
+
+    def test_load_failure(self):
+        self.create()
+        self.from_ast_file.side_effect = cindex.TranslationUnitLoadError('')
+        (viewer, index) = self.create()
+        self.assertEqual(index.parses, [self.src])
+        self.assertHasWarning(viewer)
+
+
+class TestRefresh(CodeViewerTestCase):
+    def test_unchanged(self):
+        (viewer, index) = self.create()
+        tu = viewer.tus['a.c']
+        viewer.refresh(0)
+        self.assertIs(viewer.tus['a.c'], tu)
+        self.assertEqual(tu.reparses, 0)
+        self.assertEqual(index.parses, [self.src])
+
+    def test_reparse(self):
+        (viewer, index) = self.create()
+        self.assertHasWarning(viewer)
+        tu = viewer.tus['a.c']
+        tu.diagnostics = []
+        self.touch(self.src)
+        viewer.refresh(0)
+        self.assertIs(viewer.tus['a.c'], tu)
+        self.assertEqual(tu.reparses, 1)
+        self.assertEqual(index.parses, [self.src])
+        self.assertEqual(viewer.get_all_diagnostics(), {})
+
+        # The reparsed translation unit is saved for the next run.
+        (viewer, index) = self.create()
+        self.assertEqual(index.parses, [])
+        self.assertEqual(viewer.get_all_diagnostics(), {})
+
+    def test_loaded_from_ast(self):
+        self.create()
+        (viewer, index) = self.create()
+        tu = viewer.tus['a.c']
+        self.touch(self.src)
+        viewer.refresh(0)
+        self.assertIsNot(viewer.tus['a.c'], tu)
+        self.assertEqual(tu.reparses, 0)
+        self.assertEqual(index.parses, [self.src])
+        self.assertHasWarning(viewer)
+
+        # Now that it has been parsed, it can be reparsed.
+        tu = viewer.tus['a.c']
+        self.touch(self.src)
+        viewer.refresh(0)
+        self.assertIs(viewer.tus['a.c'], tu)
+        self.assertEqual(tu.reparses, 1)
+        self.assertEqual(index.parses, [self.src])
+
+    def test_usrs(self):
+        with open(os.path.join(self.input_dir, 'b.c'), 'w') as f:
+            f.write('int b;\n')
+        (viewer, index) = self.create()
+        a_tu = viewer.tus['a.c']
+        b_tu = viewer.tus['b.c']
+        shared = viewer.usrs['c:@shared']
+        b_node = viewer.usrs['c:@b.c']
+
+        self.touch(self.src)
+        viewer.refresh(viewer.filename_to_id('a.c'))
+        self.assertEqual(a_tu.reparses, 1)
+        self.assertEqual(set(viewer.usrs), {'c:@a.c', 'c:@b.c', 'c:@shared'})
+        self.assertIn(viewer.usrs['c:@a.c'], a_tu.cursor.children)
+        self.assertIs(viewer.usrs['c:@b.c'], b_node)
+        if shared.translation_unit is b_tu:
+            self.assertIs(viewer.usrs['c:@shared'], shared)
+        else:
+            self.assertIn(viewer.usrs['c:@shared'], a_tu.cursor.children)
+
+        # Only the reparsed translation unit is walked again.
+        self.assertEqual(b_tu.cursor.walks, 1)
+        self.assertEqual(a_tu.cursor.walks, 1)
+
+
+class TestReadASTDeps(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.src = os.path.join(self.tmp_dir, 'a.c')
+        with open(self.src, 'w') as f:
+            f.write('int a;\n')
+        self.ast_filename = os.path.join(self.tmp_dir, 'a.ast')
+        self.deps_filename = os.path.join(self.tmp_dir, 'a.deps')
+
+    def write_deps(self, deps):
+        with open(self.deps_filename, 'w') as f:
+            f.write(deps)
+
+    def save(self, tu, parse_start, diagnostics=()):
+        mtime = os.stat(self.src).st_mtime_ns
+        with mock.patch.object(restserver, 'AST_CACHE_DIR', self.tmp_dir):
+            save_ast(tu, self.src, mtime, parse_start, list(diagnostics),
+                     self.ast_filename, self.deps_filename)
+
+    def write_header(self, mtime):
+        header = os.path.join(self.tmp_dir, 'a.h')
+        with open(header, 'w') as f:
+            f.write('int h;\n')
+        os.utime(header, ns=(mtime, mtime))
+        return header
+
+    def test_round_trip(self):
+        diagnostics = [[self.src, {'spelling': 'warn'}]]
+        self.save(TranslationUnit(), time.time_ns(), diagnostics)
+        self.assertTrue(os.path.exists(self.ast_filename))
+        self.assertEqual(read_ast_deps(self.deps_filename), diagnostics)
+
+    def test_header(self):
+        parse_start = time.time_ns()
+        header = self.write_header(parse_start - 60 * 10**9)
+        self.save(TranslationUnit(includes=[header]), parse_start)
+        self.assertEqual(read_ast_deps(self.deps_filename), [])
+
+        os.utime(header)
+        self.assertIsNone(read_ast_deps(self.deps_filename))
+
+    def test_header_modified_while_parsing(self):
+        self.save(TranslationUnit(), time.time_ns())
+        parse_start = time.time_ns()
+        header = self.write_header(parse_start + 10**6)
+        self.save(TranslationUnit(includes=[header]), parse_start)
+        self.assertFalse(os.path.exists(self.deps_filename))
+
+    def test_stale(self):
+        mtime = os.stat(self.src).st_mtime_ns
+        self.write_deps(json.dumps({'files': [[mtime - 1, self.src]],
+                                    'diagnostics': []}))
+        self.assertIsNone(read_ast_deps(self.deps_filename))
+
+    def test_missing_file(self):
+        self.write_deps(json.dumps({
+            'files': [[0, os.path.join(self.tmp_dir, 'missing.h')]],
+            'diagnostics': []}))
+        self.assertIsNone(read_ast_deps(self.deps_filename))
+
+    def test_corrupt(self):
+        self.assertIsNone(read_ast_deps(self.deps_filename))
+        for deps in ['', '{', '[]', '{"files": []}', '{"files": [1]}']:
+            self.write_deps(deps)
+            self.assertIsNone(read_ast_deps(self.deps_filename))
+
+
+class TestIterJSON(unittest.TestCase):
+    OBJS = [
+        {},
+        {'empty': []},
+        {
+            'filename': 'a\u00e9.c',
+            'id': 0,
+            'tokens': [{'spelling': 'int', 'kind': 'KEYWORD'}, {}],
+            'usrs': {'c:@a': {'displayname': 'a'}},
+            'none': None,
+        },
+    ]
+
+    def check(self):
+        for obj in self.OBJS:
+            self.assertEqual(json.loads(b''.join(iter_json(obj))), obj)
+
+    @unittest.skipIf(restserver.orjson is None, 'orjson is not installed')
+    def test_orjson(self):
+        self.check()
+
+    def test_json(self):
+        with mock.patch.object(restserver, 'orjson', None):
+            self.check()
+
+
+if __name__ == '__main__':
+    unittest.main()